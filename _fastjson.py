@@ -0,0 +1,20 @@
+"""Fastest available JSON implementation.
+
+Prefers orjson, falls back to ujson and then to the stdlib on
+platforms where the compiled parsers are not available. `loads`
+accepts str or bytes, `dumps` always returns str.
+"""
+
+try:
+    from orjson import loads
+    from orjson import dumps as _dumps_bytes
+
+    def dumps(obj) -> str:
+        # orjson returns bytes, the websocket wants a text frame
+        return _dumps_bytes(obj).decode()
+
+except ImportError:
+    try:
+        from ujson import loads, dumps
+    except ImportError:
+        from json import loads, dumps
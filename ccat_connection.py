@@ -1,87 +1,132 @@
+import time
 import asyncio
 import logging
-import json
 
-from cheshire_cat_api import CatClient, Config
+import aiohttp
+
+# Hoisted lookups for the per-message hot paths
+from _fastjson import loads as _loads, dumps as _dumps
 
 
 class CCatConnection:
 
-    def __init__(self, user_id, out_queue: asyncio.Queue, ccat_url: str = "localhost", ccat_port: int = 1865) -> None:
+    # One instance per active chat: slots keep the per-user memory
+    # footprint down and attribute access cheap
+    __slots__ = (
+        "user_id",
+        "_out_queue",
+        "_session",
+        "_ws_url",
+        "websocket",
+        "last_interaction",
+        "_receive_task",
+        "_last_token_forward",
+    )
+
+    def __init__(self, user_id, out_queue: asyncio.Queue, http_session: aiohttp.ClientSession, ws_base_url: str) -> None:
         self.user_id = user_id
 
-        # Get event loop
-        self._loop = asyncio.get_running_loop()
-
         # Queue of the messages to send on telegram
         self._out_queue = out_queue
-        
-        conf = Config(
-            base_url=ccat_url,
-            port=ccat_port,
-            user_id=user_id,
-        )
-
-        # Instantiate the Cheshire Cat client
-        self.ccat = CatClient(
-            config=conf,
-            on_open=self._on_open,
-            on_close=self._on_close,
-            on_message=self._ccat_message_callback
-        )
-
-        # Easy access to send
-        self.send = self.ccat.send
-
-        # This event is not None if we are waiting for ws connection open
-        self._stop_waiting_connection = None
-       
-
-    async def connect(self):
-
-        if self._stop_waiting_connection is not None:
-            logging.warning(f"Already waiting for websocket connection for user {self.user_id}")
-            return
-        
-        self.ccat.connect_ws()
 
-        logging.info(f"Waiting for websocket connection for user {self.user_id}")
+        # Shared HTTP session, one TCP connector is reused
+        # across every user's websocket
+        self._session = http_session
 
-        # Create the event to stop waiting for connection
-        self._stop_waiting_connection = asyncio.Event()
+        # Websocket url of the Cheshire Cat for this user,
+        # the base url is built once by Meowgram
+        self._ws_url = f"{ws_base_url}/{user_id}"
 
-        # Wait connection
-        await self._stop_waiting_connection.wait()
-        self._stop_waiting_connection = None
+        self.websocket: aiohttp.ClientWebSocketResponse = None
 
+        # Last user activity on the monotonic clock, read by the idle sweeper
+        self.last_interaction = time.monotonic()
 
-    def _ccat_message_callback(self, message: str):
-        # Websocket on_mesage callback
+        # Task reading the messages from the websocket
+        self._receive_task = None
 
-        message = json.loads(message)
+        # When the last chat_token was forwarded to the out queue
+        self._last_token_forward = 0.0
 
-        # Put the new message from the cat in the out queue
-        # the websocket runs in its own thread
-        # call_soon_threadsafe: https://docs.python.org/3/library/asyncio-eventloop.html#asyncio.loop.call_soon_threadsafe
-        #                       https://stackoverflow.com/questions/53669218/asyncio-queue-get-delay
-        self._loop.call_soon_threadsafe(self._out_queue.put_nowait, (message, self.user_id))
-    
-
-    def _on_open(self):
-
-        # Set the event to stop waiting for connection
-        if self._stop_waiting_connection:
-            self._stop_waiting_connection.set()
+    async def connect(self):
 
+        if self.is_connected:
+            logging.warning("Websocket connection already open for user %s", self.user_id)
+            return
 
-    def _on_close(self, status_code: int, msg: str):
+        logging.info("Connecting to the Cheshire Cat for user %s", self.user_id)
+
+        try:
+            # Compression stays off: the frames are small chat messages,
+            # usually over localhost, and deflate state costs memory per
+            # connection. The frame cap bounds memory on a misbehaving server
+            self.websocket = await self._session.ws_connect(
+                self._ws_url,
+                heartbeat=20,
+                compress=0,
+                max_msg_size=2**16,
+            )
+        except aiohttp.ClientError as e:
+            logging.error("Failed to connect to the Cheshire Cat for user %s: %s", self.user_id, e)
+            self.websocket = None
+            return
 
-        # on_close is called also if there is a connection error 
-        # so the event is set if we are waiting for connection
-        if self._stop_waiting_connection:
-            self._stop_waiting_connection.set()
+        # Start reading the messages from the cat
+        self._receive_task = asyncio.create_task(self._receive_messages())
+
+    async def disconnect(self):
+        if self._receive_task is not None:
+            self._receive_task.cancel()
+            self._receive_task = None
+
+        if self.websocket is not None:
+            await self.websocket.close()
+            self.websocket = None
+
+    async def send(self, message: str, **kwargs):
+        # Serialize with the fastest parser available, skipping the
+        # dict merge when there is nothing to merge
+        if kwargs:
+            payload = _dumps({"text": message, **kwargs})
+        else:
+            payload = _dumps({"text": message})
+
+        # The cat expects a text frame
+        await self.websocket.send_str(payload)
+
+    async def _receive_messages(self):
+        # Bind the hot attributes once, outside the per-message loop
+        put_message = self._out_queue.put_nowait
+        user_id = self.user_id
+
+        async for message in self.websocket:
+            # Enum members are singletons, identity is the cheapest check
+            if message.type is aiohttp.WSMsgType.TEXT:
+                # Put the new message from the cat in the out queue,
+                # parsed once here and passed around as a dict from now on
+                parsed = _loads(message.data)
+
+                # Tokens only refresh the typing keepalive downstream,
+                # forwarding one per second per chat is plenty
+                if parsed.get("type") == "chat_token":
+                    now = time.monotonic()
+                    if now - self._last_token_forward < 1.0:
+                        continue
+                    self._last_token_forward = now
+
+                try:
+                    put_message((parsed, user_id))
+                except asyncio.QueueFull:
+                    # Typing indicators are coalescible, drop them under
+                    # load; block only for messages that must arrive
+                    if parsed.get("type") != "chat_token":
+                        await self._out_queue.put((parsed, user_id))
+            elif message.type == aiohttp.WSMsgType.ERROR:
+                logging.error("Websocket error for user %s: %s", self.user_id, self.websocket.exception())
+                break
+
+        logging.warning("Websocket connection closed for user %s", self.user_id)
 
     @property
     def is_connected(self):
-        return self.ccat.is_ws_connected
-        
\ No newline at end of file
+        return self.websocket is not None and not self.websocket.closed
@@ -1,7 +1,10 @@
 import os
+import queue
 import logging
 import asyncio
 
+from logging.handlers import QueueHandler, QueueListener
+
 from colorlog import ColoredFormatter
 from dotenv import load_dotenv
 
@@ -9,11 +12,14 @@ from meowgram import Meowgram
 
 load_dotenv()
 
-TOKEN = os.getenv("BOT_TOKEN")
+# Parse the environment once into typed constants
+TOKEN = os.environ.get("BOT_TOKEN")
+if not TOKEN:
+    raise RuntimeError("BOT_TOKEN environment variable is not set")
 
-CCAT_URL = os.getenv("CHESHIRE_CAT_URL", "localhost")
-CCAT_PORT = os.getenv("CHESHIRE_CAT_PORT", "1865")
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+CCAT_URL = os.environ.get("CHESHIRE_CAT_URL", "localhost")
+CCAT_PORT = int(os.environ.get("CHESHIRE_CAT_PORT", "1865"))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 
 # Create a colored formatter
 formatter = ColoredFormatter(
@@ -34,8 +40,13 @@ formatter = ColoredFormatter(
 ch = logging.StreamHandler()
 ch.setFormatter(formatter)
 
-# Add the handler to the root logger
-logging.getLogger().addHandler(ch)
+# Log records are enqueued and written by a dedicated thread, so the
+# event loop never blocks on the stderr write
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, ch)
+
+# Add the queue handler to the root logger
+logging.getLogger().addHandler(QueueHandler(log_queue))
 
 # Set the logging level
 logging.getLogger().setLevel(LOG_LEVEL)
@@ -44,9 +55,23 @@ async def main():
     bot = Meowgram(
             telegram_token=TOKEN,
             ccat_url=CCAT_URL,
-            ccat_port=CCAT_PORT                  
+            ccat_port=CCAT_PORT
         )
-    await bot.run()
+
+    log_listener.start()
+    try:
+        await bot.run()
+    finally:
+        # Flush any pending records before exiting
+        log_listener.stop()
     
 if __name__ == "__main__":
+    # uvloop noticeably speeds up the asyncio event loop, fall back
+    # to the default loop where it is unavailable (e.g. Windows)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     asyncio.run(main())
\ No newline at end of file
@@ -1,28 +1,61 @@
+import io
 import os
+import sys
 import time
-import json
+import heapq
 import asyncio
 import logging
-import requests
-import tempfile
+import aiohttp
 import soundfile as sf
 
 from typing import Dict
 
-import ffmpeg
 from telegram import Update, Bot
 from telegram.ext import (
-    Application, 
-    ApplicationBuilder, 
-    ContextTypes, 
-    MessageHandler, 
-    ApplicationHandlerStop, 
+    Application,
+    ApplicationBuilder,
+    ContextTypes,
+    MessageHandler,
     filters
 )
 from telegram.constants import ChatAction
+from telegram.request import HTTPXRequest
 
 from ccat_connection import CCatConnection
 
+# Message types streamed by the cat, hoisted and interned so the
+# dispatcher compares against module constants
+_CHAT = sys.intern("chat")
+_CHAT_TOKEN = sys.intern("chat_token")
+
+# Combined update filters, built once instead of per instantiation
+_F_TEXT = filters.TEXT & (~filters.COMMAND)
+_F_VOICE = filters.VOICE & (~filters.COMMAND)
+_F_DOCUMENT = filters.Document.ALL & (~filters.COMMAND)
+
+
+def _minimal_update(update: Update) -> dict:
+    # Only the fields the cat side consumes; Update.to_json() walks and
+    # re-serializes the whole update object on every message
+    message = update.message
+    return {
+        "chat_id": update.effective_chat.id,
+        "message_id": message.message_id,
+        "from_user": update.effective_user.id,
+        "date": message.date.timestamp(),
+    }
+
+
+# Close cat connections with no user activity for this long (seconds)
+CONNECTION_TIMEOUT = 300
+
+# Hard cap on simultaneously open cat connections: when reached, the
+# least recently active chat is evicted to make room
+MAX_CONNECTIONS = 1024
+
+# How often the idle sweeper wakes up (seconds)
+SWEEP_INTERVAL = 10
+
 
 class Meowgram():
 
@@ -31,46 +64,89 @@ class Meowgram():
         self.ccat_url = ccat_url
         self.ccat_port = ccat_port
 
-        self._loop = asyncio.get_running_loop()
-
-        # Queue of the messages to send on telegram
-        self._out_queue = asyncio.Queue()
-
-        # Used to store for each connection when the last typing action is sended
-        self.last_typing_action = {}
+        # Base websocket url, built once and shared by every connection
+        self._ccat_ws_url = f"ws://{ccat_url}:{ccat_port}/ws"
 
-        self._connections: Dict[str, CCatConnection] = {}
+        self._loop = asyncio.get_running_loop()
 
-        # Create telegram application
-        self.telegram: Application = ApplicationBuilder().token(telegram_token).build()
+        # Queue of the messages to send on telegram, bounded so a slow
+        # Telegram API applies backpressure instead of growing memory
+        self._out_queue = asyncio.Queue(maxsize=1024)
+
+        # Per-chat outbound queues and their worker tasks, created
+        # lazily: ordering is preserved inside a chat while a slow
+        # send for one chat never stalls the others
+        self._chat_queues: Dict[int, asyncio.Queue] = {}
+        self._chat_workers: Dict[int, asyncio.Task] = {}
+
+        # One keepalive task per chat with a streaming reply, plus the
+        # loop-clock time of the last token seen for that chat
+        self._typing_tasks: Dict[int, asyncio.Task] = {}
+        self._typing_last_token: Dict[int, float] = {}
+
+        # Routing table of the out queue dispatcher
+        self._routes = {
+            _CHAT: self._route_chat,
+            _CHAT_TOKEN: self._route_chat_token,
+        }
+
+        self._connections: Dict[int, CCatConnection] = {}
+
+        # Per-chat locks so concurrent updates from the same user
+        # open a single websocket instead of racing the handshake
+        self._connect_locks: Dict[int, asyncio.Lock] = {}
+
+        # Min-heap of (deadline, chat_id) used to find expired
+        # connections without scanning them all, one entry per connection
+        self._conn_heap = []
+
+        # HTTP session for the TTS downloads, created in run()
+        # so it binds to the running event loop
+        self._http: aiohttp.ClientSession = None
+
+        # Bound the number of concurrent ffmpeg processes to the
+        # available cores
+        self._ffmpeg_sem = asyncio.Semaphore(os.cpu_count() or 2)
+
+        # Create telegram application.
+        # HTTP/2 multiplexes the bursts of API calls produced by token
+        # streaming (typing actions, messages) over one TLS connection
+        self.telegram: Application = (
+            ApplicationBuilder()
+            .token(telegram_token)
+            .request(HTTPXRequest(connection_pool_size=32, http_version="2"))
+            .build()
+        )
         self.bot: Bot = self.telegram.bot
 
-        # This handler open a connection to the cheshire cat for the user if it doesn't exist yet
-        self.connect_to_ccat = MessageHandler(filters.ALL, self._open_ccat_connection)
-        self.telegram.add_handler(self.connect_to_ccat)
-
-        # Handlers to manage different types of messages after the connection to the cheshire cat is opened 
-        # in the previous handler group
-        self.text_message_handler =  MessageHandler(filters.TEXT & (~filters.COMMAND), self._text_handler)
-        self.voice_message_handler = MessageHandler(filters.VOICE & (~filters.COMMAND), self._voice_note_handler)
-        self.document_message_handler = MessageHandler(filters.Document.ALL & (~filters.COMMAND), self._document_handler)
+        # Handlers to manage different types of messages, each one
+        # ensures the cat connection for the user itself
+        self.text_message_handler =  MessageHandler(_F_TEXT, self._text_handler)
+        self.voice_message_handler = MessageHandler(_F_VOICE, self._voice_note_handler)
+        self.document_message_handler = MessageHandler(_F_DOCUMENT, self._document_handler)
 
         self.telegram.add_handler(handler=self.document_message_handler, group=1)
         self.telegram.add_handler(handler=self.voice_message_handler, group=1)
         self.telegram.add_handler(handler=self.text_message_handler, group=1)
-        self.telegram.add_handler(handler=self.document_message_handler, group=1)
 
     async def run(self):
         # https://docs.python-telegram-bot.org/en/stable/telegram.ext.application.html#telegram.ext.Application.run_polling
         # Initializing and starting the app
         try:
+            # One connector shared by the TTS downloads and by
+            # every user's websocket connection
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, keepalive_timeout=60)
+            )
+
             await self.telegram.initialize()
             await self.telegram.updater.start_polling(read_timeout=10)  
             await self.telegram.start()
             
-            # Start main loop
+            # Start main loop and the idle connection sweeper
             responce_loop = self._loop.create_task(self._out_queue_dispatcher())
-            await responce_loop
+            idle_sweeper = self._loop.create_task(self._close_inactive_connections())
+            await asyncio.gather(responce_loop, idle_sweeper)
 
         except asyncio.CancelledError:
             # Cancelled error from _out_queue_dispatcher
@@ -80,57 +156,134 @@ class Meowgram():
             # Stop telegram bot application
             await self.telegram.stop()
         except Exception as e:
-            logging.exception(f"Unexpectet exeption occured: {e}")
+            logging.exception("Unexpectet exeption occured: %s", e)
         finally:
             # Shutdown telergram bot application
             await self.telegram.shutdown()
-            # Close open ws connections
-            for connection in self._connections.values():
-                if connection.ccat is not None:
-                    connection.ccat.close()
-
-    async def _open_ccat_connection(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        chat_id = update.effective_chat.id
+            # Stop the typing keepalives and the chat workers
+            for task in list(self._typing_tasks.values()):
+                task.cancel()
+            for worker in self._chat_workers.values():
+                worker.cancel()
+            # Close open ws connections in parallel, one slow peer
+            # must not serialize the teardown
+            await asyncio.gather(
+                *(connection.disconnect() for connection in self._connections.values()),
+                return_exceptions=True
+            )
+            # Close the HTTP session
+            if self._http is not None:
+                await self._http.close()
+
+    async def _ensure_connection(self, chat_id) -> CCatConnection:
+        now = time.monotonic()
+
+        connection = self._connections.get(chat_id)
+        if connection is None:
+            # Make room before growing past the cap
+            if len(self._connections) >= MAX_CONNECTIONS:
+                oldest_id = min(
+                    self._connections,
+                    key=lambda cid: self._connections[cid].last_interaction
+                )
+                logging.info("Connection limit reached, evicting user %s", oldest_id)
+                await self._retire_connection(oldest_id)
 
-        if chat_id not in self._connections:
-            self._connections[chat_id] = CCatConnection(
+            connection = CCatConnection(
                     user_id=chat_id,
                     out_queue=self._out_queue,
-                    ccat_url=self.ccat_url,
-                    ccat_port=self.ccat_port
+                    http_session=self._http,
+                    ws_base_url=self._ccat_ws_url
                 )
-            
+            self._connections[chat_id] = connection
+            # Schedule the connection for the idle sweeper
+            heapq.heappush(self._conn_heap, (now + CONNECTION_TIMEOUT, chat_id))
+
+        # Any message from the user counts as activity
+        connection.last_interaction = now
+
         # waiting for websocket connection
-        if not self._connections[chat_id].is_connected:
-            await self._connections[chat_id].connect()
+        if not connection.is_connected:
+            # Telegram handlers run concurrently: serialize the handshake
+            # per chat and re-check once the lock is held, the connection
+            # may have been opened by the handler that got there first
+            lock = self._connect_locks.setdefault(chat_id, asyncio.Lock())
+            async with lock:
+                if not connection.is_connected:
+                    await connection.connect()
 
             # If the connection is not successful, message handling is interrupted
-            if not self._connections[chat_id].is_connected:
+            if not connection.is_connected:
                 logging.warning("Interrupt handling this message, failed to connect to the Cheshire Cat")
-                raise ApplicationHandlerStop
+                return None
+
+        return connection
+
+    async def _close_inactive_connections(self):
+        # Pop only the already-expired heap entries instead of scanning
+        # every connection on each tick
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+            now = time.monotonic()
+            while self._conn_heap and self._conn_heap[0][0] <= now:
+                _, chat_id = heapq.heappop(self._conn_heap)
+
+                connection = self._connections.get(chat_id)
+                if connection is None:
+                    continue
+
+                deadline = connection.last_interaction + CONNECTION_TIMEOUT
+                if deadline <= now:
+                    logging.info("Closing inactive connection for user %s", chat_id)
+                    await self._retire_connection(chat_id)
+                else:
+                    # The user was active after this entry was pushed,
+                    # reschedule at the updated deadline
+                    heapq.heappush(self._conn_heap, (deadline, chat_id))
+
+    async def _retire_connection(self, chat_id):
+        # Close the websocket and tear down the chat's worker; any stale
+        # heap entry is discarded lazily by the sweeper
+        connection = self._connections.pop(chat_id, None)
+        if connection is not None:
+            await connection.disconnect()
+
+        worker = self._chat_workers.pop(chat_id, None)
+        if worker is not None:
+            worker.cancel()
+        self._chat_queues.pop(chat_id, None)
+        self._connect_locks.pop(chat_id, None)
 
     async def _text_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        chat_id = update.effective_chat.id
-        
+        connection = await self._ensure_connection(update.effective_chat.id)
+        if connection is None:
+            return
+
         # Send mesage to the cat
-        self._connections[chat_id].send(
-            message=update.message.text, 
+        await connection.send(
+            message=update.message.text,
             meowgram = {
-                "update": update.to_json()
+                "update": _minimal_update(update)
             },
         )
 
     async def _voice_note_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        chat_id = update.effective_chat.id
-        
-        voice_message_file = await update.message.voice.get_file()
-            
+        # The cat connection and the Telegram file resolution are
+        # independent round-trips, run them concurrently
+        connection, voice_message_file = await asyncio.gather(
+            self._ensure_connection(update.effective_chat.id),
+            update.message.voice.get_file()
+        )
+        if connection is None:
+            return
+
         # Send mesage to the cat
-        self._connections[chat_id].ccat.send(
+        await connection.send(
             message="*[Voice Note]* (You can't hear)",
             meowgram_voice=voice_message_file.file_path,
             meowgram = {
-                "update": update.to_json()
+                "update": _minimal_update(update)
             },
         )
 
@@ -139,20 +292,57 @@ class Meowgram():
 
     async def _out_queue_dispatcher(self):
         while True:
-            message, user_id = await self._out_queue.get()
+            # Block on the first message, then drain whatever else is
+            # already queued so the whole batch is dispatched concurrently
+            batch = [await self._out_queue.get()]
+            while not self._out_queue.empty():
+                batch.append(self._out_queue.get_nowait())
+
+            # Checked once per batch instead of once per message
+            debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+            routes = self._routes
+
+            for message, user_id in batch:
+                if debug_enabled:
+                    logging.debug("Message from %s: %s", user_id, message)
+
+                # One hashed lookup instead of a compare chain; missing
+                # and unknown message types are ignored as before
+                route = routes.get(message.get("type"))
+                if route is not None:
+                    route(user_id, message)
+
+    def _route_chat(self, user_id, message):
+        # Hand the message to the chat's own worker
+        self._get_chat_queue(user_id).put_nowait(message)
+
+    def _route_chat_token(self, user_id, message):
+        # Tokens only refresh the per-chat typing keepalive task,
+        # no Telegram call is made here
+        self._typing_last_token[user_id] = self._loop.time()
+
+        task = self._typing_tasks.get(user_id)
+        if task is None or task.done():
+            self._typing_tasks[user_id] = self._loop.create_task(self._typing_keepalive(user_id))
+
+    def _get_chat_queue(self, user_id) -> asyncio.Queue:
+        queue = self._chat_queues.get(user_id)
+        if queue is None:
+            queue = asyncio.Queue()
+            self._chat_queues[user_id] = queue
+            self._chat_workers[user_id] = self._loop.create_task(self._chat_worker(user_id))
+        return queue
+
+    async def _chat_worker(self, user_id):
+        queue = self._chat_queues[user_id]
 
-            logging.debug(f"Message from {user_id}: {json.dumps(message, indent=4)}")
+        while True:
+            message = await queue.get()
 
             try:
-                if message["type"] == "chat":
-                    # send the message in chat
-                    await self._dispatch_chat_message(message=message, user_id=user_id)
-                elif message['type'] == "chat_token":
-                    # Send the chat action TYPING every 5 seconds 
-                    # during the tokens streaming
-                    await self._dispatch_chat_token(user_id)
+                await self._dispatch_chat_message(message=message, user_id=user_id)
             except Exception as e:
-                logging.error(f"An error occurred sending a telegram message: {e}")
+                logging.error("An error occurred sending a telegram message: %s", e)
 
     async def _dispatch_chat_message(self, message, user_id):
         send_params = message.get("meowgram", {}).get("send_params", {})
@@ -162,76 +352,112 @@ class Meowgram():
 
         tts_url = message.get("tts", None)
         if tts_url:
-            # Get audio file
-            response = requests.get(tts_url)
-            if response.status_code != 200:
-                # If there is an error in retrieving the audio file, it sends a text message
-                await self.bot.send_message(
-                    chat_id=user_id,
-                    text=message["content"], 
-                    **send_params
-                )
-                return
-
-            with tempfile.NamedTemporaryFile() as speech_file:
-                # Write the content of the response to the temporary file
-                speech_file.write(response.content)
-
-                # Convet audio to telegram voice note fromat
-                speech_file_ogg_path = await self._loop.run_in_executor(None, self.convert_audio_to_voice, speech_file.name)
+            voice_bytes = await self._fetch_voice_note(tts_url)
 
-                # Check if converted file exists
-                if not os.path.exists(speech_file_ogg_path):
-                    return
+            if voice_bytes:
+                # Parse the ogg header in a worker thread to keep
+                # the event loop responsive
+                duration = await self._loop.run_in_executor(
+                    None, lambda: sf.info(io.BytesIO(voice_bytes)).duration
+                )
 
                 # Send voice note
                 await self.bot.send_voice(
                     chat_id=user_id,
-                    voice=open(speech_file_ogg_path, "rb"),
-                    duration=sf.info(speech_file_ogg_path).duration,
+                    voice=voice_bytes,
+                    duration=duration,
                     caption=message["content"] if settings["show_tts_text"] else None,
-                    filename=speech_file_ogg_path,
+                    filename="voice.ogg",
                     **send_params
                 )
+                return
 
-                # Remove converted file
-                os.remove(speech_file_ogg_path)
+            # If the audio could not be retrieved or converted,
+            # fall back to a text message
 
-        else:
-            # If there is no TTS URL, simply send a text message
-            await self.bot.send_message(
-                chat_id=user_id,
-                text=message["content"], 
-                **send_params
-            )
+        await self.bot.send_message(
+            chat_id=user_id,
+            text=message["content"],
+            **send_params
+        )
 
-    def convert_audio_to_voice(self, input_path: str) -> str:
+    async def _fetch_voice_note(self, tts_url: str) -> bytes:
+        # Stream the TTS download straight through ffmpeg and collect the
+        # converted note from its stdout: no temporary files involved.
         # https://stackoverflow.com/questions/56448384/telegram-bot-api-voice-message-audio-spectrogram-is-missing-a-bug
         logging.info("Convert audio file to Telegram voice note format")
-        output_path = os.path.splitext(input_path)[0] + "_converted.ogg"
-        (
-            ffmpeg.input(input_path)
-            .output(output_path, codec="libopus", audio_bitrate="32k", vbr="on", compression_level=10, frame_duration=60, application="voip")
-            .run()
-        )
-        return output_path
-
-    async def _dispatch_chat_token(self, user_id):
-        t = time.time()
 
-        if user_id not in self.last_typing_action:
-            self.last_typing_action[user_id] = t - 5
-            
-        # Check elapsed time
-        if t - self.last_typing_action[user_id] > 5:
+        async with self._ffmpeg_sem:
+            async with self._http.get(tts_url) as response:
+                if response.status != 200:
+                    logging.warning("Failed to retrieve the TTS audio: status %s", response.status)
+                    return None
+
+                process = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-i", "pipe:0",
+                    "-c:a", "libopus",
+                    "-b:a", "32k",
+                    "-vbr", "on",
+                    "-compression_level", "10",
+                    "-frame_duration", "60",
+                    "-application", "voip",
+                    "-f", "ogg", "pipe:1",
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
 
-            logging.info(f"Sending chat action Typing to user {user_id}")
+                async def feed_ffmpeg():
+                    try:
+                        async for chunk in response.content.iter_chunked(2**16):
+                            process.stdin.write(chunk)
+                            await process.stdin.drain()
+                    except (BrokenPipeError, ConnectionResetError):
+                        # ffmpeg gave up on the input; the nonzero exit
+                        # code below reports the failure
+                        pass
+                    finally:
+                        process.stdin.close()
+
+                # Copy the download into ffmpeg while reading the
+                # converted note out of it; if either side fails, make
+                # sure the child is reaped instead of left as a zombie
+                try:
+                    _, voice_bytes = await asyncio.gather(
+                        feed_ffmpeg(),
+                        process.stdout.read()
+                    )
+                except BaseException:
+                    process.kill()
+                    await process.wait()
+                    raise
+
+            if await process.wait() != 0:
+                logging.warning("ffmpeg failed to convert the TTS audio")
+                return None
+
+        return voice_bytes
+
+    async def _typing_keepalive(self, user_id):
+        # Keep the typing indicator alive for the whole stream with one
+        # task per chat instead of a throttle decision per token
+        logging.info("Typing keepalive started for user %s", user_id)
 
-            # Update the time of the last typing action
-            self.last_typing_action[user_id] = t
+        try:
+            while True:
+                await self.bot.send_chat_action(
+                    chat_id=user_id,
+                    action=ChatAction.TYPING
+                )
+                await asyncio.sleep(5)
 
-            # Send the action
-            await self.bot.send_chat_action(
-                chat_id=user_id,
-                action=ChatAction.TYPING
-            )
+                # Stop once the token stream has gone quiet
+                if self._loop.time() - self._typing_last_token.get(user_id, 0.0) > 6:
+                    return
+        except Exception as e:
+            logging.error("An error occurred sending a typing action to user %s: %s", user_id, e)
+        finally:
+            # Drop both bookkeeping entries so the dicts only hold
+            # chats with a stream currently in flight
+            self._typing_tasks.pop(user_id, None)
+            self._typing_last_token.pop(user_id, None)